@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, Text, Float
+from sqlalchemy import Column, String, Integer, DateTime, Text, Float, inspect, text
 from sqlalchemy.sql import func
 from app.database import Base
 import uuid
@@ -11,6 +11,7 @@ class Document(Base):
     file_path = Column(String, nullable=False)
     file_size = Column(Integer, nullable=False)
     content_type = Column(String, nullable=False)
+    content_hash = Column(String, index=True)  # blake2b of the file contents
     chunk_count = Column(Integer, default=0)
     status = Column(String, default="processing")  # processing, processed, error
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -18,3 +19,24 @@ class Document(Base):
     
     def __repr__(self):
         return f"<Document(id={self.id}, filename={self.filename}, status={self.status})>"
+
+def upgrade_schema(bind):
+    """
+    Bring an existing documents table up to date with the model.
+
+    create_all only creates missing tables and never alters existing ones,
+    so columns added after a deployment first created its database are
+    added here.
+
+    Args:
+        bind: Engine or connection to upgrade
+    """
+    columns = {column["name"] for column in inspect(bind).get_columns(Document.__tablename__)}
+    if "content_hash" in columns:
+        return
+
+    with bind.begin() as connection:
+        connection.execute(text("ALTER TABLE documents ADD COLUMN content_hash VARCHAR"))
+        for index in Document.__table__.indexes:
+            if "content_hash" in index.columns:
+                index.create(connection, checkfirst=True)
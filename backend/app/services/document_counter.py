@@ -0,0 +1,52 @@
+import logging
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from app.models import Document
+
+logger = logging.getLogger(__name__)
+
+class DocumentCounter:
+    """
+    In-process count of stored documents, used to enforce the document limit
+    without a COUNT(*) query on every upload.
+
+    The count is loaded from the database on first use and kept current by
+    the upload and delete endpoints, so it assumes a single worker process
+    owns the documents table. Methods never await, which makes each
+    check-and-update atomic on the event loop without an explicit lock.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._count: Optional[int] = None
+
+    def reserve(self, db: Session) -> bool:
+        """
+        Reserve a slot for a new document.
+
+        Args:
+            db: Session used to load the initial count
+
+        Returns:
+            True if a slot was reserved, False if the limit is reached
+        """
+        if self._count is None:
+            self._count = db.query(Document).count()
+            logger.info(f"Loaded document count: {self._count}")
+
+        if self._count >= self.limit:
+            return False
+
+        self._count += 1
+        return True
+
+    def release(self):
+        """Give back a slot after a failed upload or a deleted document."""
+        if self._count:
+            self._count -= 1
+
+    def reset(self):
+        """Forget the cached count so it is reloaded from the database."""
+        self._count = None
@@ -1,32 +1,131 @@
 import os
+import re
+import mmap
 import asyncio
-from typing import List, Dict, Any
+from concurrent.futures import Executor
+from typing import List, Dict, Any, Optional
 import logging
-from pathlib import Path
 
 # Document processing imports
 import PyPDF2
 import docx
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# End of a sentence, including the whitespace that follows it
+SENTENCE_END_RE = re.compile(r'[.!?]+\s+')
+
+
+def _pack_boundaries(bounds: np.ndarray, chunk_size: int, overlap: int) -> np.ndarray:
+    """
+    Greedily pack sentences into overlapping chunks.
+    
+    Args:
+        bounds: Sentence boundary offsets; sentence i spans bounds[i]..bounds[i + 1]
+        chunk_size: Maximum chunk length in characters
+        overlap: Maximum overlap between consecutive chunks in characters
+        
+    Returns:
+        Array of (start, end) sentence index pairs, one row per chunk
+    """
+    num_sentences = len(bounds) - 1
+    pairs = np.empty((max(num_sentences, 0), 2), dtype=np.int64)
+    count = 0
+    start = 0
+    prev_end = 0
+    
+    while start < num_sentences:
+        # Furthest sentence end that keeps the chunk within chunk_size
+        end = np.searchsorted(bounds, bounds[start] + chunk_size, side='right') - 1
+        
+        # A long sentence after the overlap can stop the chunk from reaching
+        # past the previous one, which would emit a suffix of that chunk;
+        # start at the previous end instead and give up the overlap.
+        if end <= prev_end:
+            start = prev_end
+            end = np.searchsorted(bounds, bounds[start] + chunk_size, side='right') - 1
+        
+        # Take at least one sentence, even if it is longer than chunk_size
+        if end < start + 1:
+            end = start + 1
+        
+        pairs[count, 0] = start
+        pairs[count, 1] = end
+        count += 1
+        prev_end = end
+        
+        if end >= num_sentences:
+            break
+        
+        # Step back over whole sentences to create the overlap
+        overlap_start = np.searchsorted(bounds, bounds[end] - overlap, side='left')
+        start = min(max(overlap_start, start + 1), end)
+    
+    return pairs[:count]
+
+
+# numba is optional: when installed the packing loop is JIT-compiled, and
+# warmed up here so the first upload doesn't pay the compilation cost.
+try:
+    from numba import njit
+except ImportError:
+    pass
+else:
+    _pack_boundaries = njit(cache=True)(_pack_boundaries)
+    _pack_boundaries(np.zeros(2, dtype=np.int64), 1, 0)
+
 class DocumentProcessor:
     """
     Document processor that handles text extraction and chunking.
     Supports PDF, DOCX, and TXT files with intelligent chunking.
+    
+    Extraction and chunking are CPU-bound, so process_document runs them in
+    an executor: a ProcessPoolExecutor for true parallelism, or the event
+    loop's default thread pool when none is given.
     """
     
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(
+        self,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+        executor: Optional[Executor] = None
+    ):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.supported_extensions = {'.pdf', '.docx', '.txt'}
+        self.executor = executor
+        self._extractors = {
+            '.pdf': self._extract_pdf_text,
+            '.docx': self._extract_docx_text,
+            '.txt': self._extract_txt_text,
+        }
+        self.supported_extensions = set(self._extractors)
         
     async def process_document(self, file_path: str, filename: str) -> List[Dict[str, Any]]:
         """
         Process a document and return chunks with metadata.
         
+        Args:
+            file_path: Path to the document file
+            filename: Original filename
+            
+        Returns:
+            List of chunks with metadata
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            process_document_file,
+            file_path,
+            filename,
+            self.chunk_size,
+            self.chunk_overlap
+        )
+    
+    def process_document_sync(self, file_path: str, filename: str) -> List[Dict[str, Any]]:
+        """
+        Process a document and return chunks with metadata (synchronous).
+        
         Args:
             file_path: Path to the document file
             filename: Original filename
@@ -38,17 +137,13 @@ class DocumentProcessor:
             logger.info(f"Processing document: {filename}")
             
             # Extract text based on file type
-            file_extension = Path(filename).suffix.lower()
-            
-            if file_extension == '.pdf':
-                text = await self._extract_pdf_text(file_path)
-            elif file_extension == '.docx':
-                text = await self._extract_docx_text(file_path)
-            elif file_extension == '.txt':
-                text = await self._extract_txt_text(file_path)
-            else:
+            file_extension = os.path.splitext(filename)[1].lower()
+            extractor = self._extractors.get(file_extension)
+            if extractor is None:
                 raise ValueError(f"Unsupported file type: {file_extension}")
             
+            text = extractor(file_path)
+            
             if not text or len(text.strip()) == 0:
                 raise ValueError("No text content extracted from document")
             
@@ -67,10 +162,10 @@ class DocumentProcessor:
             logger.error(f"Error processing document {filename}: {str(e)}")
             raise
     
-    async def _extract_pdf_text(self, file_path: str) -> str:
+    def _extract_pdf_text(self, file_path: str) -> str:
         """Extract text from PDF file."""
         try:
-            text = ""
+            parts = []
             with open(file_path, 'rb') as file:
                 pdf_reader = PyPDF2.PdfReader(file)
                 
@@ -78,38 +173,42 @@ class DocumentProcessor:
                 if len(pdf_reader.pages) > 1000:
                     raise ValueError(f"PDF has {len(pdf_reader.pages)} pages (max 1000 allowed)")
                 
+                # Pages share the reader's file stream, so they are read in order
                 for page_num, page in enumerate(pdf_reader.pages):
                     page_text = page.extract_text()
                     if page_text:
-                        text += f"\\n[Page {page_num + 1}]\\n{page_text}\\n"
-                
-            return text.strip()
+                        parts.append(f"\n[Page {page_num + 1}]\n{page_text}\n")
+            
+            return "".join(parts).strip()
             
         except Exception as e:
             logger.error(f"Error extracting PDF text: {str(e)}")
             raise
     
-    async def _extract_docx_text(self, file_path: str) -> str:
+    def _extract_docx_text(self, file_path: str) -> str:
         """Extract text from DOCX file."""
         try:
             doc = docx.Document(file_path)
-            text = ""
-            
-            for paragraph in doc.paragraphs:
-                if paragraph.text.strip():
-                    text += paragraph.text + "\\n"
             
-            return text.strip()
+            return "\n".join(
+                paragraph.text for paragraph in doc.paragraphs if paragraph.text.strip()
+            ).strip()
             
         except Exception as e:
             logger.error(f"Error extracting DOCX text: {str(e)}")
             raise
     
-    async def _extract_txt_text(self, file_path: str) -> str:
+    def _extract_txt_text(self, file_path: str) -> str:
         """Extract text from TXT file."""
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                return file.read().strip()
+            with open(file_path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return ""
+                
+                # Decode straight from the mapped pages, without first copying
+                # the whole file into an intermediate bytes object
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return str(mapped, 'utf-8', 'ignore').strip()
                 
         except Exception as e:
             logger.error(f"Error extracting TXT text: {str(e)}")
@@ -119,6 +218,11 @@ class DocumentProcessor:
         """
         Create overlapping chunks from text.
         
+        Sentences are packed greedily up to chunk_size characters; each new
+        chunk starts on the earliest sentence boundary within chunk_overlap
+        characters of the previous chunk's end, or at that end when a long
+        sentence would otherwise keep the chunk from reaching past it.
+        
         Args:
             text: Full document text
             filename: Document filename
@@ -126,69 +230,55 @@ class DocumentProcessor:
         Returns:
             List of chunk dictionaries with metadata
         """
-        chunks = []
-        sentences = text.split('.')
-        current_chunk = ""
-        current_position = 0
-        chunk_index = 0
+        # Sentence boundaries as character offsets: bounds[i]..bounds[i + 1]
+        # spans sentence i, so any run of sentences is a single slice of text.
+        ends = np.fromiter(
+            (m.end() for m in SENTENCE_END_RE.finditer(text)), dtype=np.int64
+        )
+        if len(ends) == 0 or ends[-1] != len(text):
+            ends = np.append(ends, len(text))
+        bounds = np.concatenate((np.zeros(1, dtype=np.int64), ends))
         
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if not sentence:
-                continue
-                
-            # Check if adding this sentence would exceed chunk size
-            if len(current_chunk) + len(sentence) + 1 > self.chunk_size and current_chunk:
-                # Create chunk
-                chunk_data = {
+        chunks = []
+        for start, end in _pack_boundaries(bounds, self.chunk_size, self.chunk_overlap):
+            start_char = int(bounds[start])
+            end_char = int(bounds[end])
+            chunk_text = text[start_char:end_char].strip()
+            
+            if chunk_text:
+                chunk_index = len(chunks)
+                chunks.append({
                     'id': f"{filename}_{chunk_index}",
-                    'text': current_chunk.strip(),
+                    'text': chunk_text,
                     'metadata': {
                         'document_name': filename,
                         'chunk_index': chunk_index,
-                        'start_char': current_position - len(current_chunk),
-                        'end_char': current_position,
-                        'chunk_size': len(current_chunk)
+                        'start_char': start_char,
+                        'end_char': end_char,
+                        'chunk_size': len(chunk_text)
                     }
-                }
-                chunks.append(chunk_data)
-                
-                # Start new chunk with overlap
-                overlap_text = self._get_overlap_text(current_chunk, self.chunk_overlap)
-                current_chunk = overlap_text + " " + sentence + "."
-                chunk_index += 1
-            else:
-                current_chunk += " " + sentence + "."
-            
-            current_position += len(sentence) + 1
-        
-        # Add final chunk if it has content
-        if current_chunk.strip():
-            chunk_data = {
-                'id': f"{filename}_{chunk_index}",
-                'text': current_chunk.strip(),
-                'metadata': {
-                    'document_name': filename,
-                    'chunk_index': chunk_index,
-                    'start_char': current_position - len(current_chunk),
-                    'end_char': current_position,
-                    'chunk_size': len(current_chunk)
-                }
-            }
-            chunks.append(chunk_data)
+                })
         
         return chunks
+
+
+def process_document_file(
+    file_path: str,
+    filename: str,
+    chunk_size: int,
+    chunk_overlap: int
+) -> List[Dict[str, Any]]:
+    """
+    Module-level entry point for executors; picklable for process pools.
     
-    def _get_overlap_text(self, text: str, overlap_size: int) -> str:
-        """Get the last overlap_size characters of text for chunk overlap."""
-        if len(text) <= overlap_size:
-            return text
+    Args:
+        file_path: Path to the document file
+        filename: Original filename
+        chunk_size: Maximum chunk length in characters
+        chunk_overlap: Maximum overlap between consecutive chunks
         
-        # Try to break at sentence boundary
-        overlap_text = text[-overlap_size:]
-        last_period = overlap_text.rfind('.')
-        
-        if last_period > overlap_size // 2:
-            return overlap_text[last_period + 1:].strip()
-        else:
-            return overlap_text.strip()
+    Returns:
+        List of chunks with metadata
+    """
+    processor = DocumentProcessor(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return processor.process_document_sync(file_path, filename)
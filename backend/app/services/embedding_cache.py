@@ -0,0 +1,95 @@
+import os
+import sqlite3
+import threading
+import logging
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of text embeddings.
+    Embeddings are stored as fp16 bytes in SQLite, keyed by a hash of the text.
+
+    Every method blocks on SQLite, so async callers run them in an executor;
+    the lock serialises executor threads on the shared connection.
+    """
+
+    # Stay well below SQLite's bound-parameter limit on older builds
+    _LOOKUP_BATCH_SIZE = 500
+
+    def __init__(self, path: str = "./chroma_db/embedding_cache.db", max_entries: int = 50_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, embedding BLOB NOT NULL)"
+        )
+        self._connection.commit()
+        logger.info(f"Opened embedding cache: {path}")
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        Look up cached embeddings.
+
+        Args:
+            keys: Content hashes to look up
+
+        Returns:
+            Mapping of found keys to fp32 embeddings; misses are omitted
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+
+        with self._lock:
+            for i in range(0, len(unique_keys), self._LOOKUP_BATCH_SIZE):
+                batch = unique_keys[i:i + self._LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[bytes(key)] = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+
+        return found
+
+    def put_many(self, items: Iterable[Tuple[bytes, np.ndarray]]):
+        """
+        Store embeddings, replacing any existing entry for the same key.
+
+        Entries older than the last max_entries writes are evicted.
+        Replacing an entry gives it a new rowid, so rowid order is write
+        order.
+
+        Args:
+            items: (key, embedding) pairs
+        """
+        rows = [(key, embedding.astype(np.float16).tobytes()) for key, embedding in items]
+        if not rows:
+            return
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                rows
+            )
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?",
+                (self.max_entries,)
+            )
+            self._connection.commit()
+
+    def clear(self):
+        """Remove every cached embedding."""
+        with self._lock:
+            self._connection.execute("DELETE FROM embeddings")
+            self._connection.commit()
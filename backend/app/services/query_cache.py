@@ -0,0 +1,81 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from app.schemas import QueryResponse
+
+logger = logging.getLogger(__name__)
+
+class QueryCache:
+    """
+    In-memory LRU of query responses, keyed by the normalized question,
+    the result limit and the current document set version.
+
+    Any upload or delete bumps the version through invalidate(), so a cached
+    answer is only ever served for the exact document set it was built from.
+    Invalidation only reaches this process, so like DocumentCounter it
+    assumes a single worker process serves the API; with more workers, the
+    others would keep serving answers for documents that have changed.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._version = 0
+        self._responses: "OrderedDict[bytes, QueryResponse]" = OrderedDict()
+
+    def key(self, question: str, max_results: int) -> bytes:
+        """
+        Cache key for a query against the current document set.
+
+        Take the key before retrieval starts: a response computed while an
+        upload or delete lands is then stored under the old version and is
+        never served.
+
+        Args:
+            question: User's question
+            max_results: Number of chunks the query retrieves
+
+        Returns:
+            Hash of the normalized question, result limit and document set version
+        """
+        normalized = " ".join(question.lower().split())
+        return hashlib.blake2b(
+            f"{self._version}\0{max_results}\0{normalized}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def get(self, key: bytes, question: str) -> Optional[QueryResponse]:
+        """
+        Look up a cached response.
+
+        Args:
+            key: Cache key from key()
+            question: User's question, as asked this time
+
+        Returns:
+            Cached response carrying the given question, or None on a miss
+        """
+        response = self._responses.get(key)
+        if response is None:
+            return None
+
+        self._responses.move_to_end(key)
+        logger.info(f"Query cache hit: {question[:50]}...")
+        return response.model_copy(update={"question": question})
+
+    def put(self, key: bytes, response: QueryResponse):
+        """
+        Cache a response.
+
+        Args:
+            key: Cache key from key(), taken before the response was computed
+            response: Response to cache
+        """
+        self._responses[key] = response
+        if len(self._responses) > self.maxsize:
+            self._responses.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every cached response after the document set changes."""
+        self._version += 1
+        self._responses.clear()
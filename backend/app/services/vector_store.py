@@ -1,13 +1,18 @@
 import os
 import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 import chromadb
+import torch
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 import numpy as np
 from dotenv import load_dotenv
 
+from app.services.embedding_cache import EmbeddingCache
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
@@ -15,18 +20,49 @@ class VectorStoreService:
     """
     Vector store service using ChromaDB for document chunk storage and retrieval.
     Uses sentence transformers for embedding generation.
+    
+    ChromaDB keeps the vectors in an hnswlib HNSW index, so queries are already
+    approximate nearest-neighbour graph searches, and it supports removing
+    vectors by id, which delete_document relies on.
+    
+    A loaded model, ChromaDB client and embedding cache can be passed in
+    (as tests do); otherwise the named model is loaded and both stores are
+    opened under ./chroma_db.
     """
     
+    # Upper bound on texts coalesced into one encode() call, and how long the
+    # encode worker waits for more requests before running a batch (seconds)
+    ENCODE_BATCH_MAX_TEXTS = 256
+    ENCODE_BATCH_WINDOW = 0.005
+    
+    # Number of recent query embeddings kept in memory
+    QUERY_CACHE_SIZE = 1024
+    
+    # HNSW graph parameters for new collections: M=24 links per node,
+    # ef=128 while building and ef=100 while searching. ChromaDB's default
+    # search ef of 10 is too narrow for k up to 10 and costs recall.
+    COLLECTION_METADATA = {
+        "hnsw:space": "cosine",
+        "hnsw:M": 24,
+        "hnsw:construction_ef": 128,
+        "hnsw:search_ef": 100
+    }
+    
     def __init__(
         self, 
         collection_name: str = "document_chunks",
-        embedding_model: str = "all-MiniLM-L6-v2"
+        embedding_model: str = "all-MiniLM-L6-v2",
+        embedding_batch_size: int = 64,
+        model: Optional[SentenceTransformer] = None,
+        chroma_client: Optional[chromadb.api.ClientAPI] = None,
+        embedding_cache: Optional[EmbeddingCache] = None
     ):
         self.collection_name = collection_name
         self.embedding_model_name = embedding_model
+        self.embedding_batch_size = embedding_batch_size
         
         # Initialize ChromaDB client
-        self.chroma_client = chromadb.PersistentClient(
+        self.chroma_client = chroma_client or chromadb.PersistentClient(
             path="./chroma_db",
             settings=Settings(
                 anonymized_telemetry=False,
@@ -34,9 +70,29 @@ class VectorStoreService:
             )
         )
         
-        # Initialize embedding model
-        logger.info(f"Loading embedding model: {embedding_model}")
-        self.embedding_model = SentenceTransformer(embedding_model)
+        # Initialize embedding model, on GPU in half precision when available
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if model is not None:
+            self.embedding_model = model
+        else:
+            logger.info(f"Loading embedding model: {embedding_model} on {self.device}")
+            self.embedding_model = SentenceTransformer(embedding_model, device=self.device)
+            if self.device == "cuda":
+                self.embedding_model = self.embedding_model.half()
+        
+        # Persistent embedding cache keyed by (model, text) content hash
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self._cache_key_prefix = hashlib.blake2b(
+            embedding_model.encode("utf-8") + b"\0", digest_size=16
+        )
+        
+        # In-memory LRU of recent query embeddings (fp16), keyed by query text
+        self._query_embeddings = OrderedDict()
+        
+        # Micro-batching encode queue, started lazily on the running event loop
+        self._encode_loop = None
+        self._encode_queue = None
+        self._encode_worker_task = None
         
         # Get or create collection
         try:
@@ -49,7 +105,7 @@ class VectorStoreService:
             self.collection = self.chroma_client.create_collection(
                 name=self.collection_name,
                 embedding_function=None,
-                metadata={"hnsw:space": "cosine"}
+                metadata=self.COLLECTION_METADATA
             )
             logger.info(f"Created new collection: {self.collection_name}")
     
@@ -67,27 +123,24 @@ class VectorStoreService:
         try:
             logger.info(f"Storing {len(chunks)} chunks for document {document_id}")
             
-            # Prepare data for ChromaDB
-            ids = []
-            texts = []
-            metadatas = []
-            embeddings = []
-            
-            for i, chunk in enumerate(chunks):
-                chunk_id = f"{document_id}_{i}"
-                ids.append(chunk_id)
-                texts.append(chunk['text'])
-                
-                # Add document_id to metadata
-                metadata = chunk.get('metadata', {})
-                metadata['document_id'] = document_id
-                metadatas.append(metadata)
+            # Prepare data for ChromaDB, tagging each chunk's metadata with the
+            # document_id without modifying the caller's chunk dicts
+            ids = [f"{document_id}_{i}" for i in range(len(chunks))]
+            texts = [chunk['text'] for chunk in chunks]
+            metadatas = [
+                {**chunk.get('metadata', {}), 'document_id': document_id}
+                for chunk in chunks
+            ]
             
             # Generate embeddings for all texts at once (more efficient)
             logger.info("Generating embeddings...")
             chunk_embeddings = await self._generate_embeddings(texts)
             
-            # Store in ChromaDB
+            # Store in ChromaDB. Embeddings stay fp32: Chroma's hnswlib index
+            # only holds float32 vectors, so int8 quantization here would cost
+            # recall without shrinking the index. ChromaDB 0.4.x validates
+            # embeddings as list[list[float]]; ndarray.tolist() is the cheapest
+            # way to produce that (a single C-level conversion).
             self.collection.add(
                 ids=ids,
                 documents=texts,
@@ -123,14 +176,14 @@ class VectorStoreService:
             logger.info(f"Performing similarity search: {query[:50]}...")
             
             # Generate query embedding
-            query_embedding = await self._generate_embeddings([query])
+            query_embedding = await self._embed_query(query)
             
             # Prepare where clause for filtering by document IDs if provided
             where_clause = None
             if document_ids:
                 where_clause = {"document_id": {"$in": document_ids}}
             
-            # Perform search
+            # Perform search (ChromaDB 0.4.x only accepts list[list[float]])
             results = self.collection.query(
                 query_embeddings=query_embedding.tolist(),
                 n_results=k,
@@ -181,17 +234,10 @@ class VectorStoreService:
         try:
             logger.info(f"Deleting chunks for document {document_id}")
             
-            # Get all chunk IDs for this document
-            results = self.collection.get(
-                where={"document_id": document_id},
-                include=["metadatas"]
-            )
-            
-            if results['ids']:
-                self.collection.delete(ids=results['ids'])
-                logger.info(f"Deleted {len(results['ids'])} chunks for document {document_id}")
-            else:
-                logger.info(f"No chunks found for document {document_id}")
+            # Let ChromaDB resolve the chunk IDs from the metadata index itself,
+            # instead of fetching every chunk's metadata just to read its ID
+            self.collection.delete(where={"document_id": document_id})
+            logger.info(f"Deleted chunks for document {document_id}")
             
             return True
             
@@ -228,32 +274,165 @@ class VectorStoreService:
             NumPy array of embeddings
         """
         try:
-            # Run embedding generation in a thread pool to avoid blocking
             loop = asyncio.get_event_loop()
-            embeddings = await loop.run_in_executor(
-                None, 
-                self.embedding_model.encode, 
-                texts,
-                {"normalize_embeddings": True}
+            
+            # Only texts that have never been embedded reach the model. The
+            # cache is SQLite on disk, so it is read and written in the
+            # thread pool rather than on the event loop.
+            keys = [self._cache_key(text) for text in texts]
+            embeddings_by_key = await loop.run_in_executor(
+                None, self.embedding_cache.get_many, keys
             )
-            return embeddings
+            misses = [i for i, key in enumerate(keys) if key not in embeddings_by_key]
+            
+            if misses:
+                new_embeddings = await self._encode([texts[i] for i in misses])
+                new_items = [(keys[i], embedding) for i, embedding in zip(misses, new_embeddings)]
+                await loop.run_in_executor(None, self.embedding_cache.put_many, new_items)
+                embeddings_by_key.update(new_items)
+            
+            logger.info(f"Embedding cache hits: {len(texts) - len(misses)}/{len(texts)}")
+            return np.stack([embeddings_by_key[key] for key in keys])
             
         except Exception as e:
             logger.error(f"Error generating embeddings: {str(e)}")
             raise
     
+    async def _embed_query(self, query: str) -> np.ndarray:
+        """
+        Embed a single search query, reusing recent query embeddings.
+        
+        Queries bypass the on-disk embedding cache: the in-memory LRU already
+        covers repeated questions, and persisting every query would grow the
+        cache without bound.
+        
+        Args:
+            query: Search query
+            
+        Returns:
+            NumPy array of shape (1, dim) with the query embedding
+        """
+        cached = self._query_embeddings.get(query)
+        if cached is not None:
+            self._query_embeddings.move_to_end(query)
+            return cached.astype(np.float32)[np.newaxis]
+        
+        # Encoded directly rather than through the micro-batching worker, so a
+        # one-text query never waits behind an ingest batch or the window
+        loop = asyncio.get_event_loop()
+        query_embedding = await loop.run_in_executor(None, self._encode_sync, [query])
+        
+        self._query_embeddings[query] = query_embedding[0].astype(np.float16)
+        if len(self._query_embeddings) > self.QUERY_CACHE_SIZE:
+            self._query_embeddings.popitem(last=False)
+        
+        return query_embedding
+    
+    async def _encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts through the shared micro-batching worker.
+        
+        Concurrent callers (e.g. parallel uploads) are coalesced into a single
+        encode() call so the model runs on full batches.
+        
+        Args:
+            texts: List of texts to embed
+            
+        Returns:
+            NumPy array of fp32 embeddings, in input order
+        """
+        loop = asyncio.get_event_loop()
+        
+        # The queue and worker belong to the event loop they were created on
+        if self._encode_loop is not loop:
+            self._encode_loop = loop
+            self._encode_queue = asyncio.Queue()
+            self._encode_worker_task = loop.create_task(self._encode_worker())
+        
+        future = loop.create_future()
+        await self._encode_queue.put((texts, future))
+        return await future
+    
+    async def _encode_worker(self):
+        """Drain the encode queue, running one encode() per collected batch."""
+        loop = asyncio.get_event_loop()
+        
+        while True:
+            batch = [await self._encode_queue.get()]
+            total_texts = len(batch[0][0])
+            
+            # Collect requests arriving within the batching window
+            while total_texts < self.ENCODE_BATCH_MAX_TEXTS:
+                try:
+                    item = await asyncio.wait_for(
+                        self._encode_queue.get(), timeout=self.ENCODE_BATCH_WINDOW
+                    )
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                total_texts += len(item[0])
+            
+            all_texts = [text for texts, _ in batch for text in texts]
+            
+            try:
+                # Run embedding generation in a thread pool to avoid blocking
+                embeddings = await loop.run_in_executor(None, self._encode_sync, all_texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            offset = 0
+            for texts, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset:offset + len(texts)])
+                offset += len(texts)
+    
+    def _encode_sync(self, texts: List[str]) -> np.ndarray:
+        """
+        Run the embedding model on texts (blocking).
+        
+        Args:
+            texts: List of texts to embed
+            
+        Returns:
+            NumPy array of fp32 embeddings, in input order
+        """
+        # encode() already sorts the batch by length internally (smart
+        # batching), so padding per mini-batch stays close to the minimum;
+        # a larger batch size amortises the per-batch forward pass overhead.
+        embeddings = self.embedding_model.encode(
+            texts,
+            batch_size=self.embedding_batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        
+        # fp16 models return fp16 arrays; ChromaDB expects fp32
+        return embeddings.astype(np.float32, copy=False)
+    
+    def _cache_key(self, text: str) -> bytes:
+        """Content hash of a text, scoped to the embedding model."""
+        hasher = self._cache_key_prefix.copy()
+        hasher.update(text.encode("utf-8"))
+        return hasher.digest()
+    
     def reset_collection(self):
         """
         Reset the entire collection (useful for testing).
-        WARNING: This will delete all stored chunks!
+        WARNING: This will delete all stored chunks and cached embeddings!
         """
         try:
             self.chroma_client.delete_collection(name=self.collection_name)
             self.collection = self.chroma_client.create_collection(
                 name=self.collection_name,
                 embedding_function=None,
-                metadata={"hnsw:space": "cosine"}
+                metadata=self.COLLECTION_METADATA
             )
+            self._query_embeddings.clear()
+            self.embedding_cache.clear()
             logger.info(f"Reset collection: {self.collection_name}")
         except Exception as e:
             logger.error(f"Error resetting collection: {str(e)}")
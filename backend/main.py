@@ -1,28 +1,39 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from sqlalchemy.orm import Session
 from typing import List, Optional
+import aiofiles
+import hashlib
+import json
 import os
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 import logging
+import multiprocessing
 
 from app.database import get_db, engine, Base
-from app.models import Document
+from app.models import Document, upgrade_schema
 from app.services.document_processor import DocumentProcessor
 from app.services.vector_store import VectorStoreService
-from app.services.llm_service import LLMService
+from app.services.llm_service import LLMService, EMPTY_RESPONSE_MESSAGE
+from app.services.document_counter import DocumentCounter
+from app.services.query_cache import QueryCache
 from app.schemas import DocumentResponse, QueryRequest, QueryResponse
 
-# Create tables
+# Create tables, then add any columns older databases are missing
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
 
 # Initialize FastAPI app
 app = FastAPI(
     title="RAG Document Processing API",
     description="A Retrieval-Augmented Generation pipeline for document processing and querying",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -34,15 +45,81 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Upper bound on document parsing worker processes
+PROCESS_POOL_MAX_WORKERS = 4
+
+def create_process_pool() -> ProcessPoolExecutor:
+    """
+    Create the pool that parses documents.
+    
+    Document parsing is CPU-bound, so it runs in worker processes to keep the
+    event loop free for other requests. Workers are spawned rather than
+    forked: by the first upload this process already runs executor and torch
+    threads and holds the embedding model, and forking a multithreaded
+    process can deadlock and would copy the model into every worker. Spawned
+    workers import only the document processor.
+    """
+    return ProcessPoolExecutor(
+        max_workers=min(PROCESS_POOL_MAX_WORKERS, os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
 # Initialize services
-document_processor = DocumentProcessor()
+process_pool = create_process_pool()
+document_processor = DocumentProcessor(executor=process_pool)
 vector_store = VectorStoreService()
 llm_service = LLMService()
+document_counter = DocumentCounter(limit=20)
+query_cache = QueryCache()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Read size for streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Pre-rendered bodies for the validation errors that bad clients and
+# scanners hit most often, so rejecting them skips exception handling
+# and JSON encoding
+UNSUPPORTED_TYPE_BODY = json.dumps({"detail": "Unsupported file type"}).encode()
+DOCUMENT_LIMIT_BODY = json.dumps({"detail": "Maximum document limit (20) reached"}).encode()
+NO_PROCESSED_DOCUMENTS_BODY = json.dumps({"detail": "No processed documents available for querying"}).encode()
+
+# Answer returned when retrieval finds nothing to ground a response on
+NO_RELEVANT_CHUNKS_ANSWER = "I couldn't find any relevant information in the uploaded documents to answer your question."
+
+def replace_broken_process_pool(broken_pool: ProcessPoolExecutor):
+    """
+    Swap in a fresh document parsing pool after a worker died.
+    
+    A ProcessPoolExecutor stays broken once any worker exits abruptly (e.g.
+    killed for memory on a hostile PDF), failing every later upload.
+    
+    Args:
+        broken_pool: Pool the failed upload ran on
+    """
+    global process_pool
+    
+    # Concurrent uploads on the same pool all fail; only the first replaces it
+    if process_pool is not broken_pool:
+        return
+    
+    logger.warning("Document processing pool is broken, starting a new one")
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+    process_pool = create_process_pool()
+    document_processor.executor = process_pool
+
+def error_response(status_code: int, body: bytes) -> Response:
+    """Build an error response around a pre-rendered JSON body."""
+    # A fresh Response per request: middleware such as CORS edits the
+    # headers of the response it sends, so instances can't be shared
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+@app.on_event("shutdown")
+def shutdown_process_pool():
+    process_pool.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/")
 async def root():
     return {"message": "RAG Document Processing API", "version": "1.0.0"}
@@ -56,16 +133,18 @@ async def upload_document(
     Upload and process a document for RAG system.
     Supports up to 20 documents, each with maximum 1000 pages.
     """
+    slot_reserved = False
+    vectors_stored = False
     try:
         # Validate file type
         allowed_types = ["application/pdf", "text/plain", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]
         if file.content_type not in allowed_types:
-            raise HTTPException(status_code=400, detail="Unsupported file type")
+            return error_response(400, UNSUPPORTED_TYPE_BODY)
         
-        # Check document count limit
-        doc_count = db.query(Document).count()
-        if doc_count >= 20:
-            raise HTTPException(status_code=400, detail="Maximum document limit (20) reached")
+        # Check document count limit, reserving a slot for this upload
+        if not document_counter.reserve(db):
+            return error_response(400, DOCUMENT_LIMIT_BODY)
+        slot_reserved = True
         
         # Generate unique filename
         file_id = str(uuid.uuid4())
@@ -76,13 +155,43 @@ async def upload_document(
         file_path = f"uploads/{filename}"
         os.makedirs("uploads", exist_ok=True)
         
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # Stream the upload to disk in chunks instead of buffering it in memory,
+        # hashing as we go so identical uploads can be recognised
+        file_size = 0
+        hasher = hashlib.blake2b()
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
+                file_size += len(chunk)
+                hasher.update(chunk)
+        content_hash = hasher.hexdigest()
+        
+        # Identical content is already chunked and embedded; return that document
+        existing = db.query(Document).filter(
+            Document.content_hash == content_hash,
+            Document.status == "processed"
+        ).first()
+        if existing:
+            logger.info(f"Document {file.filename} duplicates {existing.id}, skipping processing")
+            os.remove(file_path)
+            return DocumentResponse(
+                id=existing.id,
+                filename=existing.filename,
+                file_size=existing.file_size,
+                chunk_count=existing.chunk_count,
+                status=existing.status,
+                created_at=existing.created_at
+            )
         
         # Process document
         logger.info(f"Processing document: {file.filename}")
-        chunks = await document_processor.process_document(file_path, file.filename)
+        pool = document_processor.executor
+        try:
+            chunks = await document_processor.process_document(file_path, file.filename)
+        except BrokenProcessPool:
+            # Only this upload fails; later ones run on a new pool
+            replace_broken_process_pool(pool)
+            raise
         
         if not chunks:
             raise HTTPException(status_code=400, detail="Failed to extract content from document")
@@ -94,14 +203,16 @@ async def upload_document(
         # Store in vector database
         logger.info(f"Storing {len(chunks)} chunks in vector database")
         doc_id = await vector_store.store_document(file_id, chunks)
+        vectors_stored = True
         
         # Save metadata to database
         db_document = Document(
             id=file_id,
             filename=file.filename,
             file_path=file_path,
-            file_size=len(content),
+            file_size=file_size,
             content_type=file.content_type,
+            content_hash=content_hash,
             chunk_count=len(chunks),
             status="processed",
             created_at=datetime.utcnow(),
@@ -110,14 +221,16 @@ async def upload_document(
         
         db.add(db_document)
         db.commit()
+        slot_reserved = False  # the slot now belongs to the stored document
         db.refresh(db_document)
+        query_cache.invalidate()
         
         logger.info(f"Document {file.filename} processed successfully")
         
         return DocumentResponse(
             id=file_id,
             filename=file.filename,
-            file_size=len(content),
+            file_size=file_size,
             chunk_count=len(chunks),
             status="processed",
             created_at=db_document.created_at
@@ -126,8 +239,81 @@ async def upload_document(
     except HTTPException:
         raise
     except Exception as e:
+        if vectors_stored:
+            # The document row was never committed, so nothing would ever
+            # delete these vectors; remove them rather than leave orphans
+            try:
+                await vector_store.delete_document(file_id)
+            except Exception as cleanup_error:
+                logger.error(f"Error removing vectors for failed upload {file_id}: {str(cleanup_error)}")
         logger.error(f"Error processing document: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        # Give the slot back on every path that didn't store a document,
+        # including duplicates and a client disconnecting mid-upload
+        if slot_reserved:
+            document_counter.release()
+
+def has_processed_documents(db: Session) -> bool:
+    """Whether any document is ready for querying."""
+    return db.query(
+        db.query(Document.id).filter(Document.status == "processed").exists()
+    ).scalar()
+
+async def retrieve_relevant_chunks(query: QueryRequest) -> List[dict]:
+    """
+    Retrieve the chunks most relevant to a query from processed documents.
+    
+    Args:
+        query: Query request with the question and result limit
+        
+    Returns:
+        Relevant chunks, ranked by similarity
+    """
+    logger.info(f"Processing query: {query.question[:100]}...")
+    
+    # Every stored vector belongs to a processed document: uploads only keep
+    # their vectors once the document row is committed, and deletes remove
+    # them. So the search runs unfiltered; a document_id where clause makes
+    # ChromaDB load every matching chunk's metadata on each query.
+    return await vector_store.similarity_search(query.question, k=query.max_results)
+
+def format_sources(relevant_chunks: List[dict], db: Session) -> List[dict]:
+    """
+    Describe the top chunks as response sources.
+    
+    Args:
+        relevant_chunks: Relevant chunks, ranked by similarity
+        db: Database session
+        
+    Returns:
+        Source entries for up to the top 5 chunks
+    """
+    # Load all referenced documents in one query
+    top_chunks = relevant_chunks[:5]  # Limit to top 5 sources
+    document_ids = {chunk.get('document_id') for chunk in top_chunks}
+    documents = {
+        doc.id: doc
+        for doc in db.query(Document).filter(Document.id.in_(document_ids)).all()
+    }
+    
+    sources = []
+    for chunk in top_chunks:
+        doc = documents.get(chunk.get('document_id'))
+        if doc:
+            sources.append({
+                "document_id": doc.id,
+                "document_name": doc.filename,
+                "chunk_id": chunk.get('id', ''),
+                "relevance_score": chunk.get('score', 0.0)
+            })
+    
+    return sources
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Format a server-sent event with a JSON payload."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
 
 @app.post("/query", response_model=QueryResponse)
 async def query_documents(
@@ -139,51 +325,91 @@ async def query_documents(
     Retrieves relevant document chunks and generates a response.
     """
     try:
-        # Check if any documents are available
-        doc_count = db.query(Document).filter(Document.status == "processed").count()
-        if doc_count == 0:
-            raise HTTPException(status_code=400, detail="No processed documents available for querying")
+        # Repeated questions against an unchanged document set skip
+        # retrieval and generation entirely
+        cache_key = query_cache.key(query.question, query.max_results)
+        cached_response = query_cache.get(cache_key, query.question)
+        if cached_response is not None:
+            return cached_response
         
-        logger.info(f"Processing query: {query.question[:100]}...")
+        # Check if any documents are available
+        if not has_processed_documents(db):
+            return error_response(400, NO_PROCESSED_DOCUMENTS_BODY)
         
-        # Retrieve relevant chunks
-        relevant_chunks = await vector_store.similarity_search(query.question, k=query.max_results)
+        relevant_chunks = await retrieve_relevant_chunks(query)
         
         if not relevant_chunks:
-            return QueryResponse(
+            query_response = QueryResponse(
                 question=query.question,
-                answer="I couldn't find any relevant information in the uploaded documents to answer your question.",
+                answer=NO_RELEVANT_CHUNKS_ANSWER,
                 sources=[],
                 confidence=0.0
             )
+        else:
+            # Generate response using LLM
+            response = await llm_service.generate_response(query.question, relevant_chunks)
+            
+            # Chunks come back ranked by similarity, so the first is the best match
+            query_response = QueryResponse(
+                question=query.question,
+                answer=response,
+                sources=format_sources(relevant_chunks, db),
+                confidence=relevant_chunks[0].get('score', 0.0)
+            )
         
-        # Generate response using LLM
-        response = await llm_service.generate_response(query.question, relevant_chunks)
-        
-        # Format sources
-        sources = []
-        for chunk in relevant_chunks[:5]:  # Limit to top 5 sources
-            doc = db.query(Document).filter(Document.id == chunk.get('document_id')).first()
-            if doc:
-                sources.append({
-                    "document_id": doc.id,
-                    "document_name": doc.filename,
-                    "chunk_id": chunk.get('id', ''),
-                    "relevance_score": chunk.get('score', 0.0)
-                })
-        
-        return QueryResponse(
-            question=query.question,
-            answer=response,
-            sources=sources,
-            confidence=max([chunk.get('score', 0.0) for chunk in relevant_chunks]) if relevant_chunks else 0.0
-        )
+        # An empty Gemini reply is usually transient, so it isn't pinned
+        if query_response.answer != EMPTY_RESPONSE_MESSAGE:
+            query_cache.put(cache_key, query_response)
+        return query_response
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing query: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+@app.post("/query/stream")
+async def stream_query(
+    query: QueryRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Query the RAG system, streaming the answer as server-sent events.
+    Sends a "sources" event first, then one data event per piece of the
+    answer as the LLM produces it, and finally a "done" event.
+    """
+    try:
+        # Check if any documents are available
+        if not has_processed_documents(db):
+            return error_response(400, NO_PROCESSED_DOCUMENTS_BODY)
         
+        relevant_chunks = await retrieve_relevant_chunks(query)
+        sources = format_sources(relevant_chunks, db)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    
+    async def event_stream():
+        confidence = relevant_chunks[0].get('score', 0.0) if relevant_chunks else 0.0
+        yield sse_event({"sources": sources, "confidence": confidence}, event="sources")
+        
+        # Headers are already sent by now, so errors are reported in-stream
+        try:
+            if not relevant_chunks:
+                yield sse_event({"text": NO_RELEVANT_CHUNKS_ANSWER})
+            else:
+                async for text in llm_service.stream_response(query.question, relevant_chunks):
+                    yield sse_event({"text": text})
+        except Exception as e:
+            logger.error(f"Error streaming query response: {str(e)}")
+            yield sse_event({"detail": f"Internal server error: {str(e)}"}, event="error")
+            return
+        
+        yield sse_event({}, event="done")
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.get("/documents", response_model=List[DocumentResponse])
 async def list_documents(db: Session = Depends(get_db)):
@@ -228,6 +454,8 @@ async def delete_document(document_id: str, db: Session = Depends(get_db)):
         # Delete from database
         db.delete(document)
         db.commit()
+        document_counter.release()
+        query_cache.invalidate()
         
         return {"message": f"Document {document.filename} deleted successfully"}
         
@@ -4,31 +4,25 @@ Automated test runner script for RAG Document Processing API
 Provides comprehensive test execution with reporting and validation.
 """
 
-import subprocess
 import sys
 import os
 import argparse
 from pathlib import Path
 
+try:
+    import pytest
+except ImportError:
+    pytest = None
 
-def run_command(command, description):
-    """Run a command and handle errors"""
+
+def run_pytest(args, description):
+    """Run pytest in-process and report whether it passed"""
     print(f"\n{'='*60}")
     print(f"Running: {description}")
-    print(f"Command: {command}")
+    print(f"Arguments: {' '.join(args)}")
     print('='*60)
     
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    
-    if result.stdout:
-        print("STDOUT:")
-        print(result.stdout)
-    
-    if result.stderr:
-        print("STDERR:")
-        print(result.stderr)
-    
-    return result.returncode == 0
+    return pytest.main(args) == pytest.ExitCode.OK
 
 
 def main():
@@ -36,7 +30,7 @@ def main():
     parser.add_argument("--unit", action="store_true", help="Run only unit tests")
     parser.add_argument("--integration", action="store_true", help="Run only integration tests")
     parser.add_argument("--coverage", action="store_true", help="Generate coverage report")
-    parser.add_argument("--no-cleanup", action="store_true", help="Don't cleanup test databases")
+    parser.add_argument("--parallel", action="store_true", help="Spread tests across CPU cores with pytest-xdist")
     
     args = parser.parse_args()
     
@@ -48,57 +42,52 @@ def main():
     print("=" * 60)
     
     # Check if pytest is installed
-    if not run_command("python -m pytest --version", "Checking pytest installation"):
+    if pytest is None:
         print("ERROR: pytest is not installed. Please run: pip install pytest pytest-asyncio httpx")
         return 1
     
-    # Install test dependencies if needed
-    test_deps = ["pytest", "pytest-asyncio", "httpx", "pytest-cov"]
-    print(f"Installing test dependencies: {', '.join(test_deps)}")
-    if not run_command(f"pip install {' '.join(test_deps)}", "Installing test dependencies"):
-        print("WARNING: Could not install some test dependencies")
+    # Each xdist worker imports the app and opens its own in-memory databases
+    extra_args = ["-n", "auto"] if args.parallel else []
+    
+    # Coverage only sees module-level code imported after it starts, and
+    # every pytest.main call shares this process's imports, so with
+    # --coverage the measured run must be the only one
+    if args.coverage:
+        extra_args += ["--cov=app", "--cov-report=html", "--cov-report=term-missing"]
     
     success = True
     
     # Run tests based on arguments
     if args.unit:
-        success &= run_command(
-            "python -m pytest tests/test_document_retrieval.py -v -m 'not integration'",
+        success &= run_pytest(
+            ["tests/test_document_retrieval.py", "-v", "-m", "not integration", *extra_args],
             "Unit Tests for Document Retrieval"
         )
     elif args.integration:
-        success &= run_command(
-            "python -m pytest tests/test_query_integration.py -v -m 'not unit'",
+        success &= run_pytest(
+            ["tests/test_query_integration.py", "-v", "-m", "not unit", *extra_args],
             "Integration Tests for Query Handling"
         )
+    elif args.coverage:
+        success &= run_pytest(
+            ["tests/", "-v", *extra_args],
+            "All Tests with Coverage"
+        )
     else:
         # Run all tests
-        success &= run_command(
-            "python -m pytest tests/test_document_retrieval.py -v",
+        success &= run_pytest(
+            ["tests/test_document_retrieval.py", "-v", *extra_args],
             "Unit Tests for Document Retrieval"
         )
         
-        success &= run_command(
-            "python -m pytest tests/test_query_integration.py -v",
+        success &= run_pytest(
+            ["tests/test_query_integration.py", "-v", *extra_args],
             "Integration Tests for Query Handling"
         )
     
-    # Generate coverage report if requested
     if args.coverage:
-        success &= run_command(
-            "python -m pytest tests/ --cov=app --cov-report=html --cov-report=term-missing",
-            "Generating Coverage Report"
-        )
         print("\nCoverage report generated in htmlcov/ directory")
     
-    # Cleanup test databases unless disabled
-    if not args.no_cleanup:
-        cleanup_files = ["test.db", "test_integration.db"]
-        for file in cleanup_files:
-            if os.path.exists(file):
-                os.remove(file)
-                print(f"Cleaned up {file}")
-    
     # Summary
     print("\n" + "="*60)
     if success:
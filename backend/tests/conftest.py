@@ -0,0 +1,91 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from httpx import AsyncClient, ASGITransport
+
+from app.database import Base, get_db
+
+# Test database setup; StaticPool keeps every session on the same
+# connection so the in-memory database lives for the whole session
+SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool
+)
+TestingSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    join_transaction_mode="create_savepoint"
+)
+
+# pysqlite defers BEGIN until the first write, which breaks rolling back the
+# per-test transaction; emit BEGIN ourselves so SAVEPOINTs nest inside it
+@event.listens_for(engine, "connect")
+def disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine, "begin")
+def emit_begin(connection):
+    connection.exec_driver_sql("BEGIN")
+
+# Throwaway data, so when SQLALCHEMY_DATABASE_URL points at a file for
+# debugging, skip fsync and keep the journal and temp tables in memory
+@event.listens_for(engine, "connect")
+def disable_sqlite_durability(dbapi_connection, connection_record):
+    if engine.url.database in (None, "", ":memory:"):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+@pytest.fixture(scope="session")
+def app():
+    """FastAPI app, imported on first use so collecting tests doesn't load the services"""
+    from main import app as _app
+    return _app
+
+
+@pytest.fixture(scope="session", autouse=True)
+def create_schema():
+    """Create the test schema once for the session"""
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture(autouse=True)
+def db(app):
+    """Session shared by the test and the app, rolled back after the test"""
+    connection = engine.connect()
+    transaction = connection.begin()
+    # The session joins the outer transaction, so its commits only release
+    # a SAVEPOINT and every write is undone by the final rollback
+    session = TestingSessionLocal(bind=connection)
+
+    def override_get_db():
+        yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+
+    # The app's in-process caches outlive the rolled-back rows they describe
+    from main import document_counter, query_cache
+    document_counter.reset()
+    query_cache.invalidate()
+
+    yield session
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+
+@pytest_asyncio.fixture
+async def aclient(app):
+    """Async HTTP client that calls the app in-process, on the test's event loop"""
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        yield client
@@ -1,47 +1,61 @@
 import pytest
+import asyncio
+import hashlib
 import tempfile
 import os
+from concurrent.futures.process import BrokenProcessPool
 from unittest.mock import Mock, patch, AsyncMock
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
-from fastapi.testclient import TestClient
+from sqlalchemy.pool import StaticPool
 from io import BytesIO
+import numpy as np
 
-from app.database import Base, get_db
-from app.models import Document
+from app.models import Document, upgrade_schema
 from app.services.document_processor import DocumentProcessor
+from app.services.embedding_cache import EmbeddingCache
 from app.services.vector_store import VectorStoreService
-from main import app
 
-# Test database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+class FakeEmbeddingModel:
+    """Embeds each text as its length, recording every encode() batch"""
+    
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+    
+    def encode(self, texts, **kwargs):
+        self.batches.append(list(texts))
+        if self.error:
+            raise self.error
+        return np.array([[len(text)] for text in texts], dtype=np.float16)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
+def make_vector_store(model, tmp_path):
+    """VectorStoreService around a fake model, a mock ChromaDB client and a throwaway cache"""
+    return VectorStoreService(
+        model=model,
+        chroma_client=Mock(),
+        embedding_cache=EmbeddingCache(str(tmp_path / "embedding_cache.db"))
+    )
 
-app.dependency_overrides[get_db] = override_get_db
+def add_dummy_documents(db, count):
+    """Insert count processed documents"""
+    db.bulk_insert_mappings(Document, [
+        {
+            "id": f"test-doc-{i}",
+            "filename": f"test{i}.txt",
+            "file_path": f"/tmp/test{i}.txt",
+            "file_size": 100,
+            "content_type": "text/plain",
+            "chunk_count": 1,
+            "status": "processed"
+        }
+        for i in range(count)
+    ])
+    db.commit()
 
 class TestDocumentRetrieval:
     """Test class for document retrieval functionality"""
     
-    @pytest.fixture(autouse=True)
-    def setup_database(self):
-        """Setup test database before each test"""
-        Base.metadata.create_all(bind=engine)
-        yield
-        Base.metadata.drop_all(bind=engine)
-    
-    @pytest.fixture
-    def client(self):
-        """FastAPI test client"""
-        return TestClient(app)
-    
     @pytest.fixture
     def sample_pdf_file(self):
         """Create a sample PDF file for testing"""
@@ -54,18 +68,19 @@ class TestDocumentRetrieval:
         content = "This is a test document with sample content for RAG processing."
         return BytesIO(content.encode())
     
-    def test_document_upload_success(self, client, sample_text_file):
+    @pytest.mark.asyncio
+    async def test_document_upload_success(self, aclient, sample_text_file):
         """Test successful document upload"""
-        with patch('app.services.document_processor.DocumentProcessor.process_document') as mock_process, \
-             patch('app.services.vector_store.VectorStoreService.store_document') as mock_store:
+        with patch('app.services.document_processor.DocumentProcessor.process_document', new_callable=AsyncMock) as mock_process, \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock) as mock_store:
             
-            mock_process.return_value = AsyncMock(return_value=[
+            mock_process.return_value = [
                 {"content": "Test content chunk 1", "metadata": {"page": 1}},
                 {"content": "Test content chunk 2", "metadata": {"page": 1}}
-            ])
-            mock_store.return_value = AsyncMock(return_value="test-doc-id")
+            ]
+            mock_store.return_value = "test-doc-id"
             
-            response = client.post(
+            response = await aclient.post(
                 "/documents/upload",
                 files={"file": ("test.txt", sample_text_file, "text/plain")}
             )
@@ -76,11 +91,67 @@ class TestDocumentRetrieval:
             assert data["status"] == "processed"
             assert data["chunk_count"] == 2
     
-    def test_document_upload_unsupported_type(self, client):
+    @pytest.mark.asyncio
+    async def test_document_upload_duplicate_content(self, aclient, db, sample_text_file):
+        """Test that re-uploading identical content returns the existing document"""
+        content_hash = hashlib.blake2b(sample_text_file.getvalue()).hexdigest()
+        
+        db.add(Document(
+            id="existing-doc",
+            filename="original.txt",
+            file_path="/tmp/original.txt",
+            file_size=len(sample_text_file.getvalue()),
+            content_type="text/plain",
+            content_hash=content_hash,
+            chunk_count=1,
+            status="processed"
+        ))
+        db.commit()
+        
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock) as mock_process:
+            response = await aclient.post(
+                "/documents/upload",
+                files={"file": ("copy.txt", sample_text_file, "text/plain")}
+            )
+            
+            assert response.status_code == 200
+            assert response.json()["id"] == "existing-doc"
+            mock_process.assert_not_called()
+    
+    def test_upgrade_schema_adds_content_hash(self):
+        """Test that a documents table created before content_hash existed is upgraded"""
+        old_engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+        with old_engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE documents ("
+                "id VARCHAR PRIMARY KEY, filename VARCHAR NOT NULL, file_path VARCHAR NOT NULL, "
+                "file_size INTEGER NOT NULL, content_type VARCHAR NOT NULL, chunk_count INTEGER, "
+                "status VARCHAR, created_at DATETIME, updated_at DATETIME)"
+            ))
+            connection.execute(text(
+                "INSERT INTO documents (id, filename, file_path, file_size, content_type, chunk_count, status) "
+                "VALUES ('old-doc', 'old.txt', '/tmp/old.txt', 100, 'text/plain', 1, 'processed')"
+            ))
+
+        upgrade_schema(old_engine)
+        upgrade_schema(old_engine)  # a second run finds nothing to do
+
+        assert "ix_documents_content_hash" in {
+            index["name"] for index in inspect(old_engine).get_indexes("documents")
+        }
+        with sessionmaker(bind=old_engine)() as session:
+            documents = session.query(Document).all()
+            assert [doc.id for doc in documents] == ["old-doc"]
+            assert documents[0].content_hash is None
+        old_engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_document_upload_unsupported_type(self, aclient):
         """Test upload with unsupported file type"""
         fake_file = BytesIO(b"fake content")
         
-        response = client.post(
+        response = await aclient.post(
             "/documents/upload",
             files={"file": ("test.xyz", fake_file, "application/xyz")}
         )
@@ -88,26 +159,13 @@ class TestDocumentRetrieval:
         assert response.status_code == 400
         assert "Unsupported file type" in response.json()["detail"]
     
-    def test_document_upload_limit_exceeded(self, client, sample_text_file):
+    @pytest.mark.asyncio
+    async def test_document_upload_limit_exceeded(self, aclient, db, sample_text_file):
         """Test document upload when limit is exceeded"""
-        db = next(override_get_db())
-        
         # Add 20 dummy documents to exceed limit
-        for i in range(20):
-            doc = Document(
-                id=f"test-doc-{i}",
-                filename=f"test{i}.txt",
-                file_path=f"/tmp/test{i}.txt",
-                file_size=100,
-                content_type="text/plain",
-                chunk_count=1,
-                status="processed"
-            )
-            db.add(doc)
-        db.commit()
-        db.close()
+        add_dummy_documents(db, 20)
         
-        response = client.post(
+        response = await aclient.post(
             "/documents/upload",
             files={"file": ("test.txt", sample_text_file, "text/plain")}
         )
@@ -115,36 +173,188 @@ class TestDocumentRetrieval:
         assert response.status_code == 400
         assert "Maximum document limit (20) reached" in response.json()["detail"]
     
-    def test_list_documents(self, client):
-        """Test listing all documents"""
-        db = next(override_get_db())
+    @pytest.mark.parametrize("failing_method", [
+        "app.services.document_processor.DocumentProcessor.process_document",
+        "app.services.vector_store.VectorStoreService.store_document",
+    ], ids=["processing", "store"])
+    @pytest.mark.asyncio
+    async def test_failed_upload_releases_slot(self, aclient, db, sample_text_file, failing_method):
+        """Test that an upload failing after reserving the last slot gives it back"""
+        add_dummy_documents(db, 19)
         
-        # Add test documents
-        doc1 = Document(
-            id="doc1",
-            filename="test1.txt",
-            file_path="/tmp/test1.txt",
-            file_size=100,
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock, return_value=[{"text": "Chunk", "metadata": {}}]), \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock):
+            with patch(failing_method, new_callable=AsyncMock, side_effect=RuntimeError("boom")):
+                failed = await aclient.post(
+                    "/documents/upload",
+                    files={"file": ("failed.txt", BytesIO(b"Failed upload."), "text/plain")}
+                )
+            
+            retried = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+        
+        assert failed.status_code == 500
+        assert retried.status_code == 200
+    
+    @pytest.mark.asyncio
+    async def test_upload_recovers_from_broken_process_pool(self, aclient, sample_text_file):
+        """Test that a dead parsing worker fails one upload and later uploads use a new pool"""
+        import main
+        
+        # Kill a worker so the pool is broken before the upload arrives
+        broken_pool = main.create_process_pool()
+        with pytest.raises(BrokenProcessPool):
+            broken_pool.submit(os._exit, 1).result()
+        
+        with patch.object(main, 'process_pool', broken_pool), \
+             patch.object(main.document_processor, 'executor', broken_pool), \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock):
+            failed = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+            
+            # The retry is parsed for real, in a spawned worker of the new pool
+            sample_text_file.seek(0)
+            retried = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+            replacement_pool = main.process_pool
+        
+        replacement_pool.shutdown()
+        
+        assert failed.status_code == 500
+        assert replacement_pool is not broken_pool
+        assert retried.status_code == 200
+        assert retried.json()["chunk_count"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_upload_releases_slot(self, aclient, db, sample_text_file):
+        """Test that an upload cancelled mid-request (client disconnect) gives its slot back"""
+        add_dummy_documents(db, 19)
+        
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock, side_effect=asyncio.CancelledError), \
+             pytest.raises(asyncio.CancelledError):
+            await aclient.post(
+                "/documents/upload",
+                files={"file": ("cancelled.txt", BytesIO(b"Cancelled upload."), "text/plain")}
+            )
+        
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock, return_value=[{"text": "Chunk", "metadata": {}}]), \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock):
+            retried = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+        
+        assert retried.status_code == 200
+    
+    @pytest.mark.asyncio
+    async def test_failed_commit_removes_stored_vectors(self, aclient, db, sample_text_file):
+        """Test that vectors stored for an upload whose row never commits are deleted"""
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock, return_value=[{"text": "Chunk", "metadata": {}}]), \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock) as mock_store, \
+             patch('app.services.vector_store.VectorStoreService.delete_document', new_callable=AsyncMock) as mock_delete, \
+             patch.object(db, 'commit', side_effect=RuntimeError("database is locked")):
+            response = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+        
+        assert response.status_code == 500
+        stored_id = mock_store.call_args.args[0]
+        mock_delete.assert_awaited_once_with(stored_id)
+    
+    @pytest.mark.asyncio
+    async def test_duplicate_upload_releases_slot(self, aclient, db, sample_text_file):
+        """Test that a duplicate upload doesn't keep the slot it reserved"""
+        add_dummy_documents(db, 18)
+        db.add(Document(
+            id="existing-doc",
+            filename="original.txt",
+            file_path="/tmp/original.txt",
+            file_size=len(sample_text_file.getvalue()),
             content_type="text/plain",
+            content_hash=hashlib.blake2b(sample_text_file.getvalue()).hexdigest(),
             chunk_count=1,
             status="processed"
+        ))
+        db.commit()
+        
+        duplicate = await aclient.post(
+            "/documents/upload",
+            files={"file": ("copy.txt", sample_text_file, "text/plain")}
         )
-        doc2 = Document(
-            id="doc2",
-            filename="test2.txt",
-            file_path="/tmp/test2.txt",
-            file_size=200,
-            content_type="text/plain",
-            chunk_count=2,
-            status="processed"
-        )
         
-        db.add(doc1)
-        db.add(doc2)
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock, return_value=[{"text": "Chunk", "metadata": {}}]), \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock):
+            new_upload = await aclient.post(
+                "/documents/upload",
+                files={"file": ("new.txt", BytesIO(b"Different content."), "text/plain")}
+            )
+        
+        assert duplicate.json()["id"] == "existing-doc"
+        assert new_upload.status_code == 200
+    
+    @pytest.mark.asyncio
+    async def test_delete_document_frees_slot(self, aclient, db, sample_text_file):
+        """Test that deleting a document lets an upload at the limit through"""
+        add_dummy_documents(db, 20)
+        
+        with patch('app.services.document_processor.DocumentProcessor.process_document',
+                   new_callable=AsyncMock, return_value=[{"text": "Chunk", "metadata": {}}]), \
+             patch('app.services.vector_store.VectorStoreService.store_document', new_callable=AsyncMock), \
+             patch('app.services.vector_store.VectorStoreService.delete_document', new_callable=AsyncMock):
+            rejected = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+            deleted = await aclient.delete("/documents/test-doc-0")
+            sample_text_file.seek(0)
+            accepted = await aclient.post(
+                "/documents/upload",
+                files={"file": ("test.txt", sample_text_file, "text/plain")}
+            )
+        
+        assert rejected.status_code == 400
+        assert deleted.status_code == 200
+        assert accepted.status_code == 200
+    
+    @pytest.mark.asyncio
+    async def test_list_documents(self, aclient, db):
+        """Test listing all documents"""
+        # Add test documents
+        db.bulk_insert_mappings(Document, [
+            {
+                "id": "doc1",
+                "filename": "test1.txt",
+                "file_path": "/tmp/test1.txt",
+                "file_size": 100,
+                "content_type": "text/plain",
+                "chunk_count": 1,
+                "status": "processed"
+            },
+            {
+                "id": "doc2",
+                "filename": "test2.txt",
+                "file_path": "/tmp/test2.txt",
+                "file_size": 200,
+                "content_type": "text/plain",
+                "chunk_count": 2,
+                "status": "processed"
+            }
+        ])
         db.commit()
-        db.close()
         
-        response = client.get("/documents")
+        response = await aclient.get("/documents")
         
         assert response.status_code == 200
         data = response.json()
@@ -152,10 +362,9 @@ class TestDocumentRetrieval:
         assert data[0]["filename"] == "test1.txt"
         assert data[1]["filename"] == "test2.txt"
     
-    def test_delete_document_success(self, client):
+    @pytest.mark.asyncio
+    async def test_delete_document_success(self, aclient, db):
         """Test successful document deletion"""
-        db = next(override_get_db())
-        
         # Add test document
         doc = Document(
             id="test-doc-delete",
@@ -168,25 +377,24 @@ class TestDocumentRetrieval:
         )
         db.add(doc)
         db.commit()
-        db.close()
         
-        with patch('app.services.vector_store.VectorStoreService.delete_document') as mock_delete, \
+        with patch('app.services.vector_store.VectorStoreService.delete_document', new_callable=AsyncMock) as mock_delete, \
              patch('os.path.exists') as mock_exists, \
              patch('os.remove') as mock_remove:
             
-            mock_delete.return_value = AsyncMock()
             mock_exists.return_value = True
             
-            response = client.delete("/documents/test-doc-delete")
+            response = await aclient.delete("/documents/test-doc-delete")
             
             assert response.status_code == 200
             assert "deleted successfully" in response.json()["message"]
             mock_delete.assert_called_once_with("test-doc-delete")
             mock_remove.assert_called_once_with("/tmp/delete_test.txt")
     
-    def test_delete_document_not_found(self, client):
+    @pytest.mark.asyncio
+    async def test_delete_document_not_found(self, aclient):
         """Test deletion of non-existent document"""
-        response = client.delete("/documents/non-existent-doc")
+        response = await aclient.delete("/documents/non-existent-doc")
         
         assert response.status_code == 404
         assert "Document not found" in response.json()["detail"]
@@ -206,12 +414,44 @@ class TestDocumentRetrieval:
             
             assert isinstance(chunks, list)
             assert len(chunks) > 0
-            assert all("content" in chunk for chunk in chunks)
+            assert all("text" in chunk for chunk in chunks)
             assert all("metadata" in chunk for chunk in chunks)
             
         finally:
             os.unlink(temp_file_path)
-    
+
+    def test_document_processor_chunk_offsets(self):
+        """Test that chunk offsets point back into the source text"""
+        processor = DocumentProcessor(chunk_size=200, chunk_overlap=60)
+        text = " ".join(f"Sentence number {i} has some words." for i in range(100))
+
+        chunks = processor._create_chunks(text, "test.txt")
+
+        assert len(chunks) > 1
+        for index, chunk in enumerate(chunks):
+            metadata = chunk["metadata"]
+            assert metadata["chunk_index"] == index
+            assert len(chunk["text"]) <= 200
+            assert text[metadata["start_char"]:metadata["end_char"]].strip() == chunk["text"]
+
+        # Consecutive chunks overlap on whole sentences
+        assert chunks[1]["metadata"]["start_char"] < chunks[0]["metadata"]["end_char"]
+        assert chunks[1]["text"].startswith("Sentence number")
+
+    def test_document_processor_long_sentence_chunks(self):
+        """Test that a long sentence after short ones doesn't repeat the previous chunk"""
+        processor = DocumentProcessor(chunk_size=1000, chunk_overlap=200)
+        short_sentences = " ".join(f"Short sentence {i:02d}." for i in range(45))
+        text = f"{short_sentences} {' '.join(['Long'] * 180)}. {short_sentences}"
+
+        chunks = processor._create_chunks(text, "test.txt")
+
+        ends = [chunk["metadata"]["end_char"] for chunk in chunks]
+        assert ends == sorted(set(ends))
+        assert ends[-1] == len(text)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            assert chunk["text"] not in previous["text"]
+
     @pytest.mark.asyncio
     async def test_vector_store_operations(self):
         """Test vector store operations"""
@@ -223,28 +463,111 @@ class TestDocumentRetrieval:
             {"content": "This is test content 2", "metadata": {"page": 2}}
         ]
         
-        with patch.object(vector_store, 'store_document') as mock_store, \
-             patch.object(vector_store, 'similarity_search') as mock_search, \
-             patch.object(vector_store, 'delete_document') as mock_delete:
+        with patch.object(vector_store, 'store_document', new_callable=AsyncMock) as mock_store, \
+             patch.object(vector_store, 'similarity_search', new_callable=AsyncMock) as mock_search, \
+             patch.object(vector_store, 'delete_document', new_callable=AsyncMock) as mock_delete:
             
             # Test store_document
-            mock_store.return_value = AsyncMock(return_value="test-doc-id")
+            mock_store.return_value = "test-doc-id"
             doc_id = await vector_store.store_document("test-doc", test_chunks)
             assert doc_id == "test-doc-id"
             mock_store.assert_called_once_with("test-doc", test_chunks)
             
             # Test similarity_search
-            mock_search.return_value = AsyncMock(return_value=[
+            mock_search.return_value = [
                 {"content": "relevant content", "score": 0.9, "document_id": "test-doc"}
-            ])
+            ]
             results = await vector_store.similarity_search("test query", k=5)
             assert len(results) == 1
             assert results[0]["score"] == 0.9
             
             # Test delete_document
-            mock_delete.return_value = AsyncMock()
             await vector_store.delete_document("test-doc")
             mock_delete.assert_called_once_with("test-doc")
 
+    def test_embedding_cache_round_trip(self, tmp_path):
+        """Test that cached embeddings come back for their keys, within fp16 precision"""
+        cache = EmbeddingCache(str(tmp_path / "embedding_cache.db"))
+        embeddings = np.random.default_rng(0).standard_normal((2, 384)).astype(np.float32)
+        
+        cache.put_many([(b"first", embeddings[0]), (b"second", embeddings[1])])
+        found = cache.get_many([b"second", b"missing", b"first"])
+        
+        assert set(found) == {b"first", b"second"}
+        assert found[b"first"].dtype == np.float32
+        np.testing.assert_allclose(found[b"first"], embeddings[0], rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(found[b"second"], embeddings[1], rtol=1e-3, atol=1e-3)
+    
+    def test_embedding_cache_evicts_oldest_entries(self, tmp_path):
+        """Test that the cache keeps only the most recently written max_entries"""
+        cache = EmbeddingCache(str(tmp_path / "embedding_cache.db"), max_entries=3)
+        embedding = np.ones(4, dtype=np.float32)
+        
+        cache.put_many([(b"a", embedding), (b"b", embedding), (b"c", embedding)])
+        cache.put_many([(b"a", embedding), (b"d", embedding)])
+        
+        assert set(cache.get_many([b"a", b"b", b"c", b"d"])) == {b"a", b"c", b"d"}
+    
+    @pytest.mark.asyncio
+    async def test_generate_embeddings_encodes_only_misses(self, tmp_path):
+        """Test that cached texts skip the model and results keep input order"""
+        model = FakeEmbeddingModel()
+        service = make_vector_store(model, tmp_path)
+        
+        await service._generate_embeddings(["a", "bb"])
+        embeddings = await service._generate_embeddings(["bb", "ccc", "a"])
+        service._encode_worker_task.cancel()
+        
+        assert model.batches == [["a", "bb"], ["ccc"]]
+        assert embeddings[:, 0].tolist() == [2, 3, 1]
+    
+    @pytest.mark.asyncio
+    async def test_encode_coalesces_concurrent_callers(self, tmp_path):
+        """Test that concurrent encodes share one batch and each caller gets its own slice"""
+        model = FakeEmbeddingModel()
+        service = make_vector_store(model, tmp_path)
+        
+        results = await asyncio.gather(
+            service._encode(["a", "bb"]),
+            service._encode(["ccc"]),
+            service._encode(["dddd", "eeeee"])
+        )
+        service._encode_worker_task.cancel()
+        
+        assert model.batches == [["a", "bb", "ccc", "dddd", "eeeee"]]
+        assert [result[:, 0].tolist() for result in results] == [[1, 2], [3], [4, 5]]
+        assert all(result.dtype == np.float32 for result in results)
+    
+    @pytest.mark.asyncio
+    async def test_encode_error_reaches_every_caller(self, tmp_path):
+        """Test that an encode() failure is raised to every coalesced caller"""
+        service = make_vector_store(FakeEmbeddingModel(error=RuntimeError("model failed")), tmp_path)
+        
+        results = await asyncio.gather(
+            service._encode(["a"]),
+            service._encode(["bb"]),
+            return_exceptions=True
+        )
+        
+        # The worker keeps serving after a failed batch
+        service.embedding_model = FakeEmbeddingModel()
+        assert (await service._encode(["ccc"]))[:, 0].tolist() == [3]
+        service._encode_worker_task.cancel()
+        
+        assert [str(result) for result in results] == ["model failed", "model failed"]
+        assert all(isinstance(result, RuntimeError) for result in results)
+    
+    @pytest.mark.asyncio
+    async def test_embed_query_bypasses_encode_queue(self, tmp_path):
+        """Test that query embeddings don't wait on the micro-batching worker"""
+        model = FakeEmbeddingModel()
+        service = make_vector_store(model, tmp_path)
+        
+        embedding = await service._embed_query("what is ai?")
+        
+        assert embedding.shape == (1, 1)
+        assert model.batches == [["what is ai?"]]
+        assert service._encode_queue is None
+
 if __name__ == "__main__":
     pytest.main([__file__])